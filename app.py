@@ -1,5 +1,9 @@
 from langchain_community.utilities import SQLDatabase
+from sqlalchemy import text
+from functools import lru_cache
+import asyncio
 import os
+import re
 from dotenv import load_dotenv
 import gradio as gr
 
@@ -7,17 +11,160 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-db = SQLDatabase.from_uri(DATABASE_URL)
-
-from typing_extensions import TypedDict
-
-class State(TypedDict):
-    question: str
-    expanded_question: str
-    query: str
-    result: str
-    answer: str
+# Keep a healthy pool of warm connections so requests never pay the
+# TCP/TLS handshake to a remote Postgres on the hot path.
+db = SQLDatabase.from_uri(
+    DATABASE_URL,
+    engine_args={
+        "pool_size": 8,
+        "max_overflow": 4,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    },
+)
 
+with db._engine.connect() as _conn:
+    _conn.execute(text("SELECT 1"))
+
+def _load_schema_columns():
+    """Fetch column metadata for every table in one catalog query,
+    instead of a round-trip per table."""
+    with db._engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT table_name, column_name, data_type "
+            "FROM information_schema.columns "
+            "WHERE table_schema = 'public' "
+            "ORDER BY table_name, ordinal_position"
+        ))
+        columns = {}
+        for table_name, column_name, data_type in rows:
+            columns.setdefault(table_name, []).append((column_name, data_type))
+        return columns
+
+SCHEMA_COLUMNS = _load_schema_columns()
+
+_TYPE_ABBREVIATIONS = {
+    "character varying": "varchar",
+    "timestamp without time zone": "timestamp",
+    "timestamp with time zone": "timestamptz",
+    "double precision": "float",
+}
+
+def build_schema_digest():
+    """Compact one-line-per-table schema digest, e.g.
+    matches(id integer, season integer, ...) - no DDL noise or sample
+    rows, so the schema block costs a fraction of the prompt tokens of
+    db.get_table_info()."""
+    lines = []
+    for table_name, columns in SCHEMA_COLUMNS.items():
+        column_list = ", ".join(
+            f"{name} {_TYPE_ABBREVIATIONS.get(data_type, data_type)}"
+            for name, data_type in columns
+        )
+        lines.append(f"{table_name}({column_list})")
+    return "\n".join(lines)
+
+# The schema is static, so build it once at startup instead of issuing
+# metadata queries against Postgres on every request.
+TABLE_INFO = build_schema_digest()
+
+def _load_player_names():
+    with db._engine.connect() as conn:
+        rows = conn.execute(text("SELECT name FROM players"))
+        return {row[0].lower() for row in rows}
+
+# Used to decide whether a question is already detailed enough to skip
+# the LLM expansion step.
+PLAYER_NAMES = _load_player_names()
+STAT_KEYWORDS = {
+    "runs", "wickets", "sixes", "fours", "balls", "overs", "extras",
+    "average", "strike rate", "economy", "centuries", "fifties",
+    "catches", "stumpings", "run outs", "dot balls", "boundaries",
+}
+SEASON_PATTERN = re.compile(r"20\d\d|\bipl\b|\bseason\b", re.IGNORECASE)
+
+def is_detailed_question(question: str):
+    """Heuristic: long questions naming a season plus a player or stat
+    are specific enough to hand straight to the SQL generator."""
+    if len(question.split()) < 8:
+        return False
+    if not SEASON_PATTERN.search(question):
+        return False
+    lowered = question.lower()
+    if any(keyword in lowered for keyword in STAT_KEYWORDS):
+        return True
+    return any(name in lowered for name in PLAYER_NAMES)
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+# Semantic cache: near-duplicate questions ("most sixes in IPL 2023",
+# "top six-hitters 2023") hit the cache and skip the LLM pipeline entirely.
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX = 1024
+_question_encoder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+_semantic_cache_embeddings = []
+_semantic_cache_entries = []
+
+import hashlib
+from collections import OrderedDict
+from diskcache import Cache
+
+# Exact query -> result cache, so a reworded question that generates the
+# same SQL still reuses the database result.
+RESULT_CACHE_MAX = 4096
+_result_cache = OrderedDict()
+
+# Exact expanded-question -> query cache: byte-identical expansions
+# (common once the detailed-question heuristic passes questions through
+# verbatim) skip the SQL-generation LLM call entirely. Backed by
+# diskcache so hits survive restarts.
+QUERY_CACHE_MAX = 4096
+_query_cache = OrderedDict()
+_query_disk_cache = Cache(".cache/queries")
+
+def _query_cache_key(expanded_question: str):
+    return hashlib.blake2b(expanded_question.encode()).hexdigest()
+
+def query_cache_get(expanded_question: str):
+    key = _query_cache_key(expanded_question)
+    if key in _query_cache:
+        _query_cache.move_to_end(key)
+        return _query_cache[key]
+    return _query_disk_cache.get(key)
+
+def query_cache_put(expanded_question: str, query: str):
+    key = _query_cache_key(expanded_question)
+    _query_cache[key] = query
+    _query_cache.move_to_end(key)
+    while len(_query_cache) > QUERY_CACHE_MAX:
+        _query_cache.popitem(last=False)
+    _query_disk_cache[key] = query
+
+def _embed_question(question: str):
+    embedding = _question_encoder.encode(question)
+    return embedding / np.linalg.norm(embedding)
+
+def semantic_cache_lookup(question: str, llm_model: str):
+    """Return the cached pipeline output for a similar question, or None."""
+    if not _semantic_cache_entries:
+        return None
+    embedding = _embed_question(question)
+    similarities = np.stack(_semantic_cache_embeddings) @ embedding
+    for index in np.argsort(similarities)[::-1]:
+        if similarities[index] < SEMANTIC_CACHE_THRESHOLD:
+            break
+        cached_model, payload = _semantic_cache_entries[index]
+        if cached_model == llm_model:
+            return payload
+    return None
+
+def semantic_cache_store(question: str, llm_model: str, payload: dict):
+    while len(_semantic_cache_entries) >= SEMANTIC_CACHE_MAX:
+        _semantic_cache_embeddings.pop(0)
+        _semantic_cache_entries.pop(0)
+    _semantic_cache_embeddings.append(_embed_question(question))
+    _semantic_cache_entries.append((llm_model, payload))
 
 from langchain.chat_models import init_chat_model
 
@@ -116,6 +263,8 @@ LIMIT 3;
 Always join only necessary tables: player_matches, players, matches, teams
 Do not hallucinate columns—only use ones present in the schema
 Use joins correctly to relate player stats to match context
+Call the `execute_sql` tool with the SQL query to run it against the database.
+After the tool returns the result, answer the user's question in a concise, professional, well-formatted markdown response. Avoid codeblocks and quoteblocks, and clarify assumptions if needed.
 Only use the following tables and columns:
 {table_info}
 """
@@ -125,100 +274,231 @@ user_prompt = "Question: {input}"
 query_prompt_template = ChatPromptTemplate(
     [("system", system_message), ("user", user_prompt)]
 )
-from langgraph.graph import START, StateGraph
-
-from pydantic import BaseModel, Field
-
-from langchain_community.tools.sql_database.tool import QuerySQLDataBaseTool
-class QueryOutput(BaseModel):
-    query: str = Field(..., description="Syntactically valid SQL query.")
-
-def build_graph(llm):
-    def natural_language_expand(state: State):
-        prompt = (
-    f"""You are an assistant that rewrites vague or short cricket database queries into detailed, unambiguous natural language.
-    Expand and clarify the following user query into a complete and clear bullet points that can be understood by a SQL generator.
-    A bowler or a batter be referred to as a player. Always include the relevant statistics used to compute the answer, such as number of balls, runs, wickets, or other context-specific data, along with the final result.
-    Table Info: {db.get_table_info()}
-    Do not suggest any column names that are not defined in the given schema.
-    To find debut matches, use date to determine the first match played by a player.
-    Never mention ids, always use full names of players and teams.
-    For a match id, show the match date and season and teams involved.
-    User Query: {state["question"]}"""
-        )
-        response = llm.invoke(prompt)
-        return {"expanded_question": response.content}
-
-    def write_query(state: State):
-        """Generate SQL query to fetch information."""
-        prompt = query_prompt_template.invoke(
-            {
-                "dialect": db.dialect,
-                "top_k": 10,
-                "table_info": db.get_table_info(),
-                "input": state["expanded_question"],
-            }
-        )
-        structured_llm = llm.with_structured_output(QueryOutput)
-        result = structured_llm.invoke(prompt)
-        return {"query": result.query}
-
-    def execute_query(state: State):
-        """Execute SQL query."""
-        execute_query_tool = QuerySQLDataBaseTool(db=db)
-        return {"result": execute_query_tool.invoke(state["query"])}
-
-    def generate_answer(state: State):
-        """Answer question using retrieved information as context."""
-        prompt = (
-f"""
-You are a helpful assistant that explains SQL query results to users in a clear and professional way.
-Avoid using codeblocks and quoteblocks.
-
-Given the following:
-- **User Question**: {state["question"]}
-- **SQL Query Executed**: {state["query"]}
-- **SQL Result**: {state["result"]}
-
-Generate a well-formatted, professional markdown response that:
-1. Answers the user's question based on the result.
-2. Is written in a concise, user-friendly tone.
-3. Optionally adds helpful context or clarifies assumptions if needed.
-
-Ensure the response is easy to read and technically accurate.
-"""
-        )
-        response = llm.invoke(prompt)
-        return {"answer": response.content}
 
+# dialect, top_k and the schema never change between requests, so bind
+# them once instead of re-interpolating the multi-KB system message.
+BOUND_PROMPT = query_prompt_template.partial(
+    dialect=db.dialect, top_k=10, table_info=TABLE_INFO
+)
+
+# Kept byte-identical across requests and sent as the system turn, so
+# providers with prompt caching (Gemini implicit prefix cache etc.) can
+# skip prefill for the shared prefix; only the user turn varies.
+EXPAND_SYSTEM_MESSAGE = f"""You are an assistant that rewrites vague or short cricket database queries into detailed, unambiguous natural language.
+Expand and clarify the user query into a complete and clear bullet points that can be understood by a SQL generator.
+A bowler or a batter be referred to as a player. Always include the relevant statistics used to compute the answer, such as number of balls, runs, wickets, or other context-specific data, along with the final result.
+Table Info: {TABLE_INFO}
+Do not suggest any column names that are not defined in the given schema.
+To find debut matches, use date to determine the first match played by a player.
+Never mention ids, always use full names of players and teams.
+For a match id, show the match date and season and teams involved."""
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.tools import tool
 
-    graph_builder = StateGraph(State).add_sequence(
-        [natural_language_expand, write_query, execute_query, generate_answer]
-    )
-    graph_builder.add_edge(START, "natural_language_expand")
-    graph = graph_builder.compile()
+from sqlalchemy.exc import SQLAlchemyError
 
-    return graph
+# Broad queries should not materialize the whole result set in memory.
+MAX_RESULT_ROWS = 100
 
-def process_question(question: str, llm_model: str):
-    if not question:
-        return "❌ Error: Please enter a question.", "", "", ""
+def run_query(query: str):
+    """Execute SQL with a server-side cursor so rows arrive in batches,
+    and stop after MAX_RESULT_ROWS instead of fetching everything."""
     try:
-        llm_model, llm_provider = get_llm(llm_model)
-        llm = init_chat_model(llm_model, model_provider=llm_provider)
-        graph = build_graph(llm)
-        state: State = {"question": question, "expanded_question": "", "query": "", "result": "", "answer": ""}
-        result = graph.invoke(state)
-
+        with db._engine.connect().execution_options(
+            stream_results=True, max_row_buffer=1000
+        ) as conn:
+            rows = conn.execute(text(query)).fetchmany(MAX_RESULT_ROWS)
+            if not rows:
+                return ""
+            return str([tuple(row) for row in rows])
+    except SQLAlchemyError as e:
+        return f"Error: {e}"
+
+def validate_query(query: str):
+    """Cheap EXPLAIN preflight: catches malformed SQL without paying for
+    full execution. Returns None if the query plans cleanly, otherwise
+    the database error text."""
+    try:
+        with db._engine.connect() as conn:
+            conn.execute(text("EXPLAIN " + query))
+        return None
+    except SQLAlchemyError as e:
+        return f"Error: {e}"
+
+@tool
+def execute_sql(query: str) -> str:
+    """Execute a syntactically valid PostgreSQL query against the IPL
+    database and return the resulting rows."""
+    return run_query(query)
+
+async def _execute_with_cache(query: str):
+    if query in _result_cache:
+        _result_cache.move_to_end(query)
+        return _result_cache[query]
+    error = await asyncio.to_thread(validate_query, query)
+    if error is not None:
+        # Surface the planner error as the tool result so the model can
+        # repair the SQL on its next turn instead of failing the request.
         return (
-            "📋 Final Answer\n\n" + result.get("answer", ""),
-            "🧠 Expanded Question\n\n" + result.get("expanded_question", ""),
-            "📄 SQL Query\n\n" + result.get("query", ""),
-            "📊 Query Result\n\n" + result.get("result", "No result found"),
+            error
+            + "\nThe query failed EXPLAIN validation. Fix the SQL and call execute_sql again."
         )
+    result = await asyncio.to_thread(run_query, query)
+    # EXPLAIN can pass but execution still fail (timeouts, runtime
+    # errors); never serve such a failure from cache.
+    if not result.startswith("Error:"):
+        _result_cache[query] = result
+        while len(_result_cache) > RESULT_CACHE_MAX:
+            _result_cache.popitem(last=False)
+    return result
+
+# Concurrent calls arriving within this window are sent as one batch.
+BATCH_WINDOW_SECONDS = 0.02
+BATCH_MAX_SIZE = 8
+
+class LLMBatcher:
+    """Coalesces concurrent calls to a runnable into a single abatch.
+
+    Providers get much better throughput from batched requests than from
+    independent ones, and all callers share the warmed connection. Each
+    caller awaits its own future, so latency only grows by the batching
+    window."""
+
+    def __init__(self, runnable):
+        self._runnable = runnable
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    async def ainvoke(self, prompt):
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((prompt, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                while len(batch) < BATCH_MAX_SIZE:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), BATCH_WINDOW_SECONDS)
+                    )
+            except asyncio.TimeoutError:
+                pass
+            try:
+                results = await self._runnable.abatch([prompt for prompt, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    if not future.cancelled():
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+
+@lru_cache(maxsize=None)
+def get_runtime(llm_model: str):
+    """One chat model, tool binding and batcher set per model choice,
+    shared by all requests so the batchers can coalesce across users."""
+    llm_name, llm_provider = get_llm(llm_model)
+    llm = init_chat_model(llm_name, model_provider=llm_provider)
+    sql_llm = llm.bind_tools([execute_sql])
+    return LLMBatcher(llm), LLMBatcher(sql_llm), sql_llm
+
+async def natural_language_expand(question: str, expand_batcher: LLMBatcher):
+    """Rewrite a vague question into detailed bullet points; detailed
+    questions pass through unchanged."""
+    if is_detailed_question(question):
+        return question
+    messages = [
+        ("system", EXPAND_SYSTEM_MESSAGE),
+        ("user", "User Query: " + question),
+    ]
+    response = await expand_batcher.ainvoke(messages)
+    return response.content
+
+# Safety valve on the tool-calling loop.
+MAX_TOOL_TURNS = 3
+
+async def process_question(question: str, llm_model: str):
+    if not question:
+        yield "❌ Error: Please enter a question.", "", "", ""
+        return
+    try:
+        cached = semantic_cache_lookup(question, llm_model)
+        if cached is not None:
+            yield (
+                "📋 Final Answer\n\n" + cached.get("answer", ""),
+                "🧠 Expanded Question\n\n" + cached.get("expanded_question", ""),
+                "📄 SQL Query\n\n" + cached.get("query", ""),
+                "📊 Query Result\n\n" + cached.get("result", "No result found"),
+            )
+            return
+
+        expand_batcher, sql_batcher, sql_llm = get_runtime(llm_model)
+        expanded = await natural_language_expand(question, expand_batcher)
+        expanded_md = "🧠 Expanded Question\n\n" + expanded
+
+        # One conversation covers SQL generation, execution and the
+        # explanation: the model emits the query as an execute_sql tool
+        # call, the rows come back as the tool result, and the next turn
+        # of the same (prefix-cached) context is the final answer.
+        messages = list(BOUND_PROMPT.invoke({"input": expanded}).to_messages())
+        cached_query = query_cache_get(expanded)
+        if cached_query is not None:
+            # Known SQL for this expansion: skip the generation call and
+            # jump straight to execution.
+            response = AIMessage(content="", tool_calls=[
+                {"name": "execute_sql", "args": {"query": cached_query}, "id": "cached-query"}
+            ])
+        else:
+            response = await sql_batcher.ainvoke(messages)
+
+        query, result, answer = "", "", ""
+        query_md = "📄 SQL Query\n\n"
+        result_md = "📊 Query Result\n\n"
+        for _ in range(MAX_TOOL_TURNS):
+            if not response.tool_calls:
+                answer = response.content
+                break
+            messages.append(response)
+            for tool_call in response.tool_calls:
+                query = tool_call["args"].get("query", "")
+                result = await _execute_with_cache(query)
+                messages.append(ToolMessage(content=result, tool_call_id=tool_call["id"]))
+            query_md = "📄 SQL Query\n\n" + query
+            result_md = "📊 Query Result\n\n" + (result or "No result found")
+            yield "📋 Final Answer\n\n", expanded_md, query_md, result_md
+
+            # The next turn is normally the explanation; stream it so
+            # tokens appear as soon as the model produces them.
+            response = None
+            async for chunk in sql_llm.astream(messages):
+                response = chunk if response is None else response + chunk
+                if chunk.content:
+                    answer = response.content
+                    yield "📋 Final Answer\n\n" + answer, expanded_md, query_md, result_md
+            if response is None or not response.tool_calls:
+                break
+
+        # Not every path through the loop streams (e.g. the model answers
+        # inline without a tool call), so always render the final state.
+        yield "📋 Final Answer\n\n" + answer, expanded_md, query_md, result_md
+
+        if query and result and not result.startswith("Error:"):
+            query_cache_put(expanded, query)
+        # Only cache successful runs; a transient failure must not be
+        # replayed to every similar question for the life of the process.
+        if answer and result and not result.startswith("Error:"):
+            semantic_cache_store(question, llm_model, {
+                "expanded_question": expanded,
+                "query": query,
+                "result": result,
+                "answer": answer,
+            })
 
     except Exception as e:
-        return f"❌ Error: {str(e)}", "", "", ""
+        yield f"❌ Error: {str(e)}", "", "", ""
 
 # Gradio UI
 with gr.Blocks(title="🏏 IPL Natural Language Stats Explorer") as demo:
@@ -255,7 +535,12 @@ with gr.Blocks(title="🏏 IPL Natural Language Stats Explorer") as demo:
     submit_button.click(
         fn=process_question,
         inputs=[question_input, llm_model],
-        outputs=[final_answer, expanded_question, sql_query, query_result]
+        outputs=[final_answer, expanded_question, sql_query, query_result],
+        show_progress="minimal",
     )
 
+# The pipeline is network-bound, so overlapping in-flight requests is
+# the main throughput lever; process_question is async so the queue can
+# truly interleave them.
+demo.queue(default_concurrency_limit=8, max_size=64)
 demo.launch()
\ No newline at end of file